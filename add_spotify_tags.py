@@ -3,67 +3,217 @@ from mutagen.oggvorbis import OggVorbis
 from mutagen.flac import Picture
 import argparse
 import logging
-import json
-from jsonpath_ng.ext import parse
+import ijson
 import requests
-import base64
-import copy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import binascii
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import shelve
+import dbm
 from spotify_backup import SpotifyAPI, CLIENT_ID, SCOPE
 
 logging.basicConfig(level=20, datefmt='%I:%M:%S',
                     format='[%(asctime)s] %(message)s')
 
+DEFAULT_CACHE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'spotify-backup', 'tracks.db')
+
+
+# Streams the elements of the top-level `key` list of a spotify-backup json file,
+# without loading the whole file into memory.
+def iter_backup(filename, key):
+    with open(filename, 'rb') as f:
+        yield from ijson.items(f, f'{key}.item', use_float=True)
+
 
 class SpotifyInfo(object):
+    __slots__ = ('title', 'artist', 'album', 'tracknumber', 'image', 'year',
+                 'spotify_id')
+
     def __init__(self):
-        self.title = None
-        self.artist = None
-        self.album = None
-        self.tracknumber = None
-        self.image = None
-        self.year = None
-        self.spotify_id = None
+        for name in self.__slots__:
+            setattr(self, name, None)
 
-    def __getitem__(self, name):
-        return getattr(self, name)
+    def items(self):
+        return ((name, getattr(self, name)) for name in self.__slots__)
 
-    def __setitem__(self, name, value):
-        return setattr(self, name, value)
+    def __str__(self):
+        return (', '.join("%s: %s" % item for item in self.items()))
 
-    def __delitem__(self, name):
-        return delattr(self, name)
 
-    def __contains__(self, name):
-        return hasattr(self, name)
+# Picks the second largest album cover if there is one, otherwise the only one.
+def album_image(entry):
+    images = entry['album']['images']
+    if len(images) > 1:
+        return images[1]
+    elif len(images) == 1:
+        return images[0]
+    return None
 
-    def __str__(self):
-        return (', '.join("%s: %s" % item for item in vars(self).items()))
+
+# Files having all of these are considered tagged already and are left alone.
+COMPLETE_TAGS = ('title', 'artist', 'album', 'tracknumber', 'year',
+                 'metadata_block_picture')
+
+
+def is_tagged(ogg):
+    return all(ogg.get(tag) for tag in COMPLETE_TAGS)
 
 
 class Tagger(object):
-    def __init__(self, cache, spotify):
+    # Maximum number of IDs accepted by the Spotify "Get Several Tracks" endpoint.
+    BATCH_SIZE = 50
+    # Number of concurrent cover art downloads.
+    IMAGE_WORKERS = 16
+
+    def __init__(self, cache, spotify, cache_file=None):
         self.cache = cache
         self.spotify = spotify
+        self.images = {}
+        # Cover URLs write_tags couldn't download; not retried during this run.
+        self.failed_images = set()
+        # IDs the batch endpoint didn't know; not looked up again during this run.
+        self.not_found = set()
+        # When set to a dict, collects tracks fetched from the API (see _write_tags).
+        self.fetched = None
+        # Reuse connections to the image CDN instead of reconnecting per download.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Tracks fetched from the API are persisted here between runs. Without API
+        # access nothing can be added, so an existing cache is only read.
+        self.disk_cache = None
+        if cache_file and spotify:
+            os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+            self.disk_cache = shelve.open(cache_file)
+        elif cache_file and dbm.whichdb(cache_file):
+            self.disk_cache = shelve.open(cache_file, flag='r')
 
-    def get_spotify_info(self, spotify_id) -> SpotifyInfo:
-        entry = None
+    def close(self):
+        self.session.close()
+        if self.disk_cache is not None:
+            self.disk_cache.close()
+            self.disk_cache = None
+
+    def cached_entry(self, spotify_id):
         if spotify_id in self.cache:
-            entry = self.cache[spotify_id]
-        elif self.spotify:
+            return self.cache[spotify_id]
+        if self.disk_cache is not None and spotify_id in self.disk_cache:
+            entry = self.cache[spotify_id] = self.disk_cache[spotify_id]
+            return entry
+        return None
+
+    def store_entry(self, spotify_id, entry):
+        self.cache[spotify_id] = entry
+        if self.fetched is not None:
+            self.fetched[spotify_id] = entry
+        if self.disk_cache is not None:
+            self.disk_cache[spotify_id] = entry
+
+    # Fetches everything needed to tag the files. Returns {filename: Spotify ID}
+    # of the files that still need tagging.
+    def prefetch(self, filenames):
+        wanted = {}
+        missing = set()
+        need_picture = set()
+        for filename in filenames:
+            ogg = OggVorbis(filename)
+            if 'spotify_id' not in ogg.tags or is_tagged(ogg):
+                continue
+            spotify_id = ogg.tags.get('spotify_id')[0]
+            wanted[filename] = spotify_id
+            if self.cached_entry(spotify_id) is None:
+                missing.add(spotify_id)
+            if not ogg.get('metadata_block_picture'):
+                need_picture.add(spotify_id)
+
+        if self.spotify:
+            self.prefetch_tracks(sorted(missing))
+
+        # Only tracks known by now get their cover prefetched, the rest are left
+        # to write_tags.
+        urls = set()
+        for spotify_id in need_picture:
+            entry = self.cached_entry(spotify_id)
+            image = album_image(entry) if entry is not None else None
+            if image is not None:
+                urls.add(image['url'])
+        self.prefetch_images(urls)
+        return wanted
+
+    def prefetch_tracks(self, spotify_ids):
+        for i in range(0, len(spotify_ids), self.BATCH_SIZE):
+            chunk = spotify_ids[i:i + self.BATCH_SIZE]
+            logging.info(
+                f'Fetching {len(chunk)} tracks from Spotify ({i + len(chunk)}/{len(spotify_ids)})')
+            try:
+                response = self.spotify.get(
+                    'tracks', params={'ids': ','.join(chunk)}, tries=2)
+            except Exception as err:
+                logging.error(err)
+                continue
+            # Results come back in request order, with null for unknown IDs.
+            for spotify_id, entry in zip(chunk, response['tracks']):
+                if entry is None:
+                    self.not_found.add(spotify_id)
+                else:
+                    self.store_entry(spotify_id, entry)
+
+    # Downloads cover art concurrently into self.images. Failed downloads are
+    # left out and retried once by write_tags.
+    def prefetch_images(self, urls):
+        if not urls:
+            return
+        logging.info(f'Fetching {len(urls)} cover images')
+
+        def fetch(url):
+            try:
+                return url, self.fetch_image(url)
+            except Exception as err:
+                logging.error(f"Couldn't fetch {url} ({err})")
+                return url, None
+
+        with ThreadPoolExecutor(max_workers=self.IMAGE_WORKERS) as executor:
+            for url, image in executor.map(fetch, urls):
+                if image is not None:
+                    self.images[url] = image
+
+    # Returns the prefetched cover of a track as {url: image}, or {} if there's none.
+    def images_for(self, spotify_id):
+        entry = self.cached_entry(spotify_id) if spotify_id else None
+        image = album_image(entry) if entry is not None else None
+        if image is None or image['url'] not in self.images:
+            return {}
+        return {image['url']: self.images[image['url']]}
+
+    # Returns (data, mime type) of an image.
+    def fetch_image(self, url):
+        with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            # Read the body in one go, rather than via iter_content() chunks.
+            return r.raw.read(decode_content=True), r.headers.get('content-type')
+
+    def get_spotify_info(self, spotify_id) -> SpotifyInfo:
+        entry = self.cached_entry(spotify_id)
+        if entry is None and self.spotify and spotify_id not in self.not_found:
             try:
                 entry = self.spotify.get(f'tracks/{spotify_id}', tries=2)
             except Exception as err:
                 logging.error(err)
+            else:
+                self.store_entry(spotify_id, entry)
 
         if entry is None:
             return None
 
         info = SpotifyInfo()
         info.spotify_id = spotify_id
-        if len(entry['album']['images']) > 1:
-            info.image = entry['album']['images'][1]
-        elif len(entry['album']['images']) == 1:
-            info.image = entry['album']['images'][0]
+        info.image = album_image(entry)
         info.tracknumber = str(entry['track_number'])
         info.album = entry['album']['name']
         info.year = entry['album']['release_date'][0:4]
@@ -80,6 +230,10 @@ class Tagger(object):
             logging.info(f'No SPOTIFY_ID tag present in {filename}, skipping')
             return
 
+        if is_tagged(ogg):
+            logging.debug(f'{filename} is already tagged, skipping')
+            return
+
         spotify_id = ogg.tags.get('spotify_id')[0]
         info = self.get_spotify_info(spotify_id)
 
@@ -89,30 +243,40 @@ class Tagger(object):
             return
 
         changed = False
-        for var in vars(info):
-            if info[var] is None:
+        for var, value in info.items():
+            if value is None:
                 continue
             if var == 'image':
                 if not ogg.get('metadata_block_picture'):  # need to fetch the picture
-                    logging.info(
-                        f'Fetching {info.image["url"]} ({info.image["width"]}x{info.image["height"]})')
-                    r = requests.get(info.image['url'])
+                    url = info.image['url']
+                    image = self.images.get(url)
+                    if image is None and url not in self.failed_images:
+                        logging.info(
+                            f'Fetching {url} ({info.image["width"]}x{info.image["height"]})')
+                        try:
+                            image = self.images[url] = self.fetch_image(url)
+                        except Exception as err:
+                            logging.error(f"Couldn't fetch {url} ({err})")
+                            self.failed_images.add(url)
+                    if image is None:  # leave the picture out, keep the other tags
+                        continue
+                    data, mime = image
                     picture = Picture()
-                    picture.data = r.content
+                    picture.data = data
                     picture.description = "coverart"
                     picture.type = 3
                     picture.width = info.image['width']
                     picture.height = info.image['height']
-                    picture.mime = r.headers.get('content-type')
+                    picture.mime = mime
                     picture_data = picture.write()
-                    encoded_data = base64.b64encode(picture_data)
+                    encoded_data = binascii.b2a_base64(picture_data, newline=False)
                     vcomment_value = encoded_data.decode("ascii")
 
                     changed = True
                     ogg["metadata_block_picture"] = [vcomment_value]
                 continue
 
-            arr = info[var] if isinstance(info[var], list) else [info[var]]
+            arr = value if isinstance(value, list) else [value]
             if arr != ogg.get(var, []):
                 logging.info(f"Setting {var} from {ogg.get(var)} to {arr}")
                 changed = True
@@ -123,6 +287,27 @@ class Tagger(object):
             ogg.save()
 
 
+# Tagger of a --jobs worker process, set up by _init_worker.
+_worker_tagger = None
+
+
+def _init_worker(cache, spotify, not_found):
+    global _worker_tagger
+    _worker_tagger = Tagger(cache, spotify)
+    _worker_tagger.not_found = not_found
+    _worker_tagger.fetched = {}
+
+
+# Tags a file in a worker process, given the file's prefetched cover. Workers have no
+# disk cache, so tracks they fetch from the API are returned for the parent to store.
+def _write_tags(task):
+    filename, images = task
+    _worker_tagger.images = images
+    _worker_tagger.write_tags(filename)
+    fetched, _worker_tagger.fetched = _worker_tagger.fetched, {}
+    return fetched
+
+
 def main():
     # Parse arguments.
     parser = argparse.ArgumentParser(
@@ -133,6 +318,11 @@ def main():
                         help="spotify-backup json file (used to avoid querying Spotify API)")
     parser.add_argument('--offline', action=argparse.BooleanOptionalAction,
                         help="Don't query Spotify API (requires --json)")
+    parser.add_argument('--cache', metavar="FILE", default=DEFAULT_CACHE_FILE,
+                        help="file caching tracks fetched from Spotify API between runs. Entries never expire, "
+                             "delete the file to clear it. Read-only with --offline, empty to disable")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of files to tag in parallel")
     parser.add_argument('files', metavar='FILE', nargs='*',
                         help='files to write tags to')
     args = parser.parse_args()
@@ -147,25 +337,42 @@ def main():
 
     track_cache = {}
     if args.json:
-        f = open(args.json, 'r')
         logging.info(f'Opening {args.json}')
-        jsonobj = json.load(f)
 
-        jsonpath_expression = parse("$..track where [id]")
-        for match in jsonpath_expression.find(jsonobj):
-            track_cache[match.value.get('id')] = match.value
+        # The backup layout is fixed, so walk it directly:
+        # playlists[].tracks[].track and albums[].album.tracks.items[]
+        for p in iter_backup(args.json, 'playlists'):
+            for item in p['tracks']:
+                track = item.get('track')
+                if track and track.get('id'):
+                    track_cache[track['id']] = track
 
-        jsonpath_expression = parse("$..album where [tracks]")
-        for match in jsonpath_expression.find(jsonobj):
-            for track in match.value['tracks']['items']:
-                t = copy.deepcopy(track)
-                t['album'] = match.value
-                track_cache[t.get('id')] = t
+        for a in iter_backup(args.json, 'albums'):
+            album = a['album']
+            for track in album['tracks']['items']:
+                track_cache[track.get('id')] = {**track, 'album': album}
 
-    tagger = Tagger(track_cache, spotify)
+    tagger = Tagger(track_cache, spotify, args.cache)
 
-    for fname in args.files:
-        tagger.write_tags(fname)
+    try:
+        # Look up all uncached tracks upfront, in batches.
+        wanted = tagger.prefetch(args.files)
+
+        if args.jobs > 1 and len(wanted) > 1:
+            # Workers only need the entries of the files left to tag, and each task
+            # carries just its own cover.
+            cache = {k: tagger.cache[k] for k in set(wanted.values()) if k in tagger.cache}
+            tasks = ((fname, tagger.images_for(wanted.get(fname))) for fname in args.files)
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                                     initargs=(cache, spotify, tagger.not_found)) as executor:
+                for fetched in executor.map(_write_tags, tasks, chunksize=16):
+                    for spotify_id, entry in fetched.items():
+                        tagger.store_entry(spotify_id, entry)
+        else:
+            for fname in args.files:
+                tagger.write_tags(fname)
+    finally:
+        tagger.close()
 
 
 if __name__ == '__main__':
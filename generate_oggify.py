@@ -2,7 +2,8 @@
 from enum import Enum
 import argparse
 from shlex import quote
-import json
+import ijson
+import itertools
 import logging
 import os
 import sys
@@ -41,72 +42,89 @@ logging.info(f"Arguments: {args}")
 
 
 class Folder(object):
-    def __init__(self, name):
+    def __init__(self, name, songs):
         self.name = name
-        self.songs = []
-
-    def add_song(self, spotify_id):
-        if not spotify_id.startswith('spotify:track:'):
-            return
-        self.songs.append(spotify_id)
+        self.songs = songs
+        self.n_songs = len(songs)
 
     def __repr__(self):
-        return f'{self.name} ({len(self.songs)})'
+        return f'{self.name} ({self.n_songs})'
 
 
-def sanitize_filename(fn):
+# See add_spotify_tags.iter_backup (not imported, to keep this script free of its dependencies).
+def iter_backup(filename, key):
+    with open(filename, 'rb') as f:
+        yield from ijson.items(f, f'{key}.item', use_float=True)
+
+
+# str.translate() table for sanitize_filename. Entries are computed on first
+# use of each character, so the table only grows to the alphabet actually seen.
+class _FilenameTable(dict):
     validchars = "-_.()&'\"[],!+ "
-    out = ""
-    for c in fn:
-        if str.isalpha(c) or str.isdigit(c) or (c in validchars):
-            out += c
+
+    def __missing__(self, cp):
+        c = chr(cp)
+        if c.isalpha() or c.isdigit() or c in self.validchars:
+            out = c
+        elif c == "–":
+            out = "-"
         else:
-            if c == "–":
-                out += "-"
-            else:
-                out += "_"
-    return quote(out)
+            out = "_"
+        self[cp] = out
+        return out
 
 
-logging.info(f'Parsing {args.json}...')
-with open(args.json, 'r') as f:
-    jsonobj = json.load(f)
-
-    folders = []
-
-    things_to_export = []
-    if args.playlists:
-        logging.info(f'Exporting playlists')
-        things_to_export += jsonobj['playlists']
-    if args.albums:
-        logging.info(f'Exporting albums')
-        things_to_export += jsonobj['albums']
-
-    for p in things_to_export:
-        is_album = 'album' in p
-        if is_album:
-            folder_name = f"{', '.join([a['name'] for a in p['album']['artists']])} - {p['album']['name']} ({p['album']['release_date'][0:4]})"
-        else:
-            folder_name = p['name']
+_FILENAME_TABLE = _FilenameTable()
 
-        if args.filter:
-            if args.filter.lower() not in folder_name.lower() and ('id' not in p or p['id'] != args.filter):
-                logging.info(f"Skipping {folder_name}")
-                continue
-        if args.owner:
-            if 'owner' in p and p['owner']['id'] != args.owner:
-                logging.info(f"Skipping {folder_name}")
-                continue
 
-        folder = Folder(folder_name)
-        # playlist_data = [ p for p in playlist_data if p['owner']['id'] == me['id'] ]
+def sanitize_filename(fn):
+    return quote(fn.translate(_FILENAME_TABLE))
 
-        tracks = p['album']['tracks']['items'] if is_album else p['tracks']
-        for t in tracks:
-            folder.add_song(t['uri'] if 'uri' in t else t['track']['uri'])
 
-        if len(folder.songs):
-            folders.append(folder)
+def album_folder_name(album):
+    return f"{', '.join([a['name'] for a in album['artists']])} - {album['name']} ({album['release_date'][0:4]})"
+
+
+logging.info(f'Parsing {args.json}...')
+folders = []
+
+things_to_export = []
+if args.playlists:
+    logging.info(f'Exporting playlists')
+    things_to_export.append(iter_backup(args.json, 'playlists'))
+if args.albums:
+    logging.info(f'Exporting albums')
+    things_to_export.append(iter_backup(args.json, 'albums'))
+
+filter_lower = args.filter.lower() if args.filter else None
+
+for p in itertools.chain.from_iterable(things_to_export):
+    is_album = 'album' in p
+    name = p['album']['name'] if is_album else p['name']
+
+    # Run the cheap checks first, album folder names are only formatted for items that pass.
+    if args.owner:
+        if 'owner' in p and p['owner']['id'] != args.owner:
+            logging.info(f"Skipping {name}")
+            continue
+    if filter_lower and p.get('id') != args.filter and filter_lower not in name.lower():
+        if not is_album or filter_lower not in album_folder_name(p['album']).lower():
+            logging.info(f"Skipping {name}")
+            continue
+
+    folder_name = album_folder_name(p['album']) if is_album else name
+
+    # playlist_data = [ p for p in playlist_data if p['owner']['id'] == me['id'] ]
+
+    # Album tracks carry the URI directly, playlist items nest it under 'track'.
+    # Local files and podcast episodes are left out.
+    tracks = p['album']['tracks']['items'] if is_album else p['tracks']
+    folder = Folder(folder_name, [
+        uri for uri in (t.get('uri') or t['track']['uri'] for t in tracks)
+        if uri.startswith('spotify:track:')])
+
+    if folder.n_songs:
+        folders.append(folder)
 
 if len(folders) == 0:
     logging.error(
@@ -137,70 +155,92 @@ cat > "${{fname}}"
 echo "${{fname}}"
 """
 
-with open(args.bash, 'w') as bash:
-    print("#!/bin/bash", file=bash)
-    print(textwrap.dedent(f"""\
-        set -e # enable errexit option
+HEADER = textwrap.dedent("""\
+    #!/bin/bash
+    set -e # enable errexit option
+
+    command -v vorbiscomment >/dev/null 2>&1 || {{ echo >&2 "vorbiscomment is required, but it's not installed.  Aborting."; exit 1; }}
+
+    if [ -z "$SPOTIFY_USER" -o -z "$SPOTIFY_PASS" ]; then
+        echo "SPOTIFY_USER and SPOTIFY_PASS envvars must be set"
+        exit 1
+    fi
+
+    OGGIFY_BIN="${{1:-{oggify_bin}}}"
+
+    echo "Creating tag_ogg script..."
+    temp_file=$(mktemp)
+    cat << 'EOF' > ${{temp_file}}
+    """)
+
+FUNCTIONS = textwrap.dedent("""\
+    EOF
+    chmod u+x ${temp_file}
+
+    # Returns spotify URL value for all .ogg files in current directory. 
+    # Since oggify writes tags after downloading tracks, this represents all completed downloads.
+    # Requires vorbiscomment from vorbis-tools.
+    downloaded_tracks() {
+        if command -v vorbiscomment &> /dev/null; then
+            for fname in *.ogg
+            do
+                [ -f "$fname" ] || continue 
+                vorbiscomment -l "$fname" | grep SPOTIFY_ID | awk -F= ' {print "spotify:track:" $2}'
+            done
+        fi
+    }
+
+    # Returns spotify URLs of files that were passed in stdin but are not already downloaded.
+    # Used when the script resumes downloading. Duplicates are dropped, order is kept.
+    skip_downloaded() {
+        awk 'FILENAME == ARGV[1] { seen[$0]; next } !($0 in seen) { seen[$0]; print }' <(cached_downloaded_tracks) -
+    }
+
+    # downloaded_tracks output is cached in a file, as the current directory only changes
+    # when a folder is finished. skip_downloaded runs in a pipeline subshell, so the file's
+    # existence (not a variable) marks the cache as filled.
+    cache_dir=$(mktemp -d)
+    downloaded_cache="${cache_dir}/downloaded_tracks"
+    cached_downloaded_tracks() {
+        [ -f "$downloaded_cache" ] || downloaded_tracks > "$downloaded_cache"
+        cat "$downloaded_cache"
+    }
+    """)
+
+# Create all files in current directory, then move them to the target one.
+FOLDER = textwrap.dedent("""
+    if [ ! -d {folder} ]; then
+        echo Processing {folder} - {n} files:
+        skip_downloaded <<< "{song_ids}" | "$OGGIFY_BIN" "$SPOTIFY_USER" "$SPOTIFY_PASS" "$temp_file"
+        if compgen -G "*.ogg" > /dev/null; then
+            mkdir {folder}
+            mv *.ogg {folder}
+            # No .ogg files are left in the current directory.
+            : > "$downloaded_cache"
+        fi
+    fi
+    """)
 
-        command -v vorbiscomment >/dev/null 2>&1 || {{ echo >&2 "vorbiscomment is required, but it's not installed.  Aborting."; exit 1; }}
+FOOTER = textwrap.dedent("""\
+    echo Cleaning up...
+    rm ${temp_file}
+    rm -r "${cache_dir}"
+    echo Done. Use \"add_spotify_tags.py --json spotify-backup.json ./**/*.ogg\" to add Spotify tags to the files.
 
-        if [ -z "$SPOTIFY_USER" -o -z "$SPOTIFY_PASS" ]; then
-            echo "SPOTIFY_USER and SPOTIFY_PASS envvars must be set"
-            exit 1
-        fi
+    """)
 
-        OGGIFY_BIN="${{1:-{quote(args.oggify_bin)}}}"
-
-        echo "Creating tag_ogg script..."
-        temp_file=$(mktemp)
-        cat << 'EOF' > ${{temp_file}}"""), file=bash)
-    print(TAG_OGG, file=bash)
-    print(textwrap.dedent(f"""\
-        EOF
-        chmod u+x ${{temp_file}}
-
-        # Returns spotify URL value for all .ogg files in current directory. 
-        # Since oggify writes tags after downloading tracks, this represents all completed downloads.
-        # Requires vorbiscomment from vorbis-tools.
-        downloaded_tracks() {{
-            if command -v vorbiscomment &> /dev/null; then
-                for fname in *.ogg
-                do
-                    [ -f "$fname" ] || continue 
-                    vorbiscomment -l "$fname" | grep SPOTIFY_ID | awk -F= ' {{print "spotify:track:" $2}}'
-                done
-            fi
-        }}
-
-        # Returns spotify URLs of files that were passed in stdin but are not already downloaded.
-        # Used when the script resumes downloading.
-        skip_downloaded() {{
-            comm -13 <(downloaded_tracks | sort | uniq) <(cat /dev/stdin | sort | uniq)
-        }}"""), file=bash)
-
-    newline = "\n"
-    for f in sorted(folders, key=lambda f: len(f.songs)):
-        logging.info(f"Processing {f.name} (songs: {len(f.songs)})...")
-        folder = sanitize_filename(f.name)
-        song_ids = newline.join([id for id in f.songs])
-
-        # Create all files in current directory, then move them to the target one.
-        print(textwrap.dedent(f"""
-            if [ ! -d {folder} ]; then
-                echo Processing {folder} - {len(f.songs)} files:
-                skip_downloaded <<< """) + f'"{song_ids}" | "$OGGIFY_BIN" "$SPOTIFY_USER" "$SPOTIFY_PASS" "$temp_file"'
-              + textwrap.dedent(f"""
-                if compgen -G "*.ogg" > /dev/null; then
-                    mkdir {folder}
-                    mv *.ogg {folder}
-                fi
-            fi"""), file=bash)
-
-    print(textwrap.dedent("""\
-        echo Cleaning up...
-        rm ${temp_file}
-        echo Done. Use \"add_spotify_tags.py --json spotify-backup.json ./**/*.ogg\" to add Spotify tags to the files.
-        """), file=bash)
+chunks = [HEADER.format(oggify_bin=quote(args.oggify_bin)), TAG_OGG, "\n", FUNCTIONS]
+
+folders.sort(key=lambda f: f.n_songs)
+for f in folders:
+    logging.info(f"Processing {f.name} (songs: {f.n_songs})...")
+    chunks.append(FOLDER.format(folder=sanitize_filename(f.name), n=f.n_songs,
+                                song_ids="\n".join(f.songs)))
+
+chunks.append(FOOTER)
+
+with open(args.bash, 'w') as bash:
+    bash.write(''.join(chunks))
 
 # chmod u+x to Bash file
 os.chmod(args.bash, os.stat(args.bash).st_mode | stat.S_IXUSR)